@@ -4,16 +4,71 @@ Simple batch downloader for public iCloud shared albums.
 """
 
 import argparse
+import collections
+import glob
+import hashlib
 import logging
 import requests
-import json
 import sys
 import os
+import pathlib
 import random
-from typing import List
+import shutil
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson is considerably faster on the large webasseturls payloads, but stays optional
+try:
+    import orjson as _json
+    _loads = _json.loads
+    _dumps = _json.dumps
+except ImportError:
+    import json as _json
+    _loads = _json.loads
+
+    def _dumps(obj) -> bytes:
+        return _json.dumps(obj).encode()
+
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Number of times the webstream request may be redirected to another host
+_MAX_HOST_REDIRECTS = 5
+
+# (connect, read) timeouts in seconds, so a stalled connection cannot hang a worker forever
+_TIMEOUT = (10, 30)
+
+# Assets of at least this size (mostly videos) are fetched with parallel range
+# requests, since the CDN limits the throughput of a single connection.
+_RANGED_DOWNLOAD_THRESHOLD = 32 << 20
+_RANGED_DOWNLOAD_PARTS = 4
+
+def _http_adapter(pool_maxsize: int = 64) -> HTTPAdapter:
+    """
+    Build the adapter for the shared session, keeping up to pool_maxsize
+    connections per host alive.
+    """
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504],
+                  allowed_methods=["GET", "POST"], respect_retry_after_header=True)
+    return HTTPAdapter(pool_connections=32, pool_maxsize=pool_maxsize, max_retries=retry)
+
+# Shared session so that connections to the iCloud hosts are kept alive and
+# reused across requests instead of doing a new TLS handshake per photo.
+_SESSION = requests.Session()
+_SESSION.mount("https://", _http_adapter())
+
+def _post_json(url: str, payload: dict) -> requests.Response:
+    """
+    POST the payload as a JSON body through the shared session.
+    """
+    return _SESSION.post(url, data=_dumps(payload), headers=_JSON_HEADERS, timeout=_TIMEOUT, allow_redirects=True)
 
 # Merged url_utils.py content
 BASE_62_CHAR_SET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+_BASE_62_VALUES = {c: i for i, c in enumerate(BASE_62_CHAR_SET)}
 
 def base62_to_int(part: str) -> int:
     """
@@ -21,133 +76,264 @@ def base62_to_int(part: str) -> int:
     """
     t = 0
     for c in part:
-        t = t * 62 + BASE_62_CHAR_SET.index(c)
+        t = t * 62 + _BASE_62_VALUES[c]
     return t
 
-def get_partition(url_token: str):
+def get_partition(url_token: str) -> int:
     """
     Extract partition from url token.
     (Based on JS code)
     """
-    partition = 0
     if 'A' == url_token[0]:
-        partition = base62_to_int([url_token[1]])
-    else:
-        partition = base62_to_int(url_token[1:3])
-    return partition
+        return _BASE_62_VALUES[url_token[1]]
+    return base62_to_int(url_token[1:3])
 
-def get_url_location(item: dict) -> str:
+def get_download_url(item: dict) -> str:
     """
-    Extracts URL location from a given item dictionary.
+    Constructs the full download URL from item dictionary.
     """
-    return item.get('url_location')
+    return f"https://{item['url_location']}{item['url_path']}"
 
-def get_url_path(item: dict) -> str:
+def get_source_filename(url: str) -> str:
     """
-    Extracts URL path from a given item dictionary.
+    Extract the source filename from the URL path (the last path segment before the query).
     """
-    return item.get('url_path')
+    return url.split('?', 1)[0].rpartition('/')[2]
 
-def get_download_url(item: dict) -> str:
+# Original iclouder.py content
+def _derivative_size(derivative: dict) -> int:
     """
-    Constructs the full download URL from item dictionary.
+    Number of pixels of a photo derivative.
     """
-    url_location = get_url_location(item)
-    url_path = get_url_path(item)
-    return f"https://{url_location}{url_path}"
+    return int(derivative.get('width') or 0) * int(derivative.get('height') or 0)
 
-def get_source_filename(url: str) -> str:
+def get_best_checksums(photos: List[dict]) -> List[str]:
     """
-    Extract the source filename from the URL path.
+    Makes sure to check which of the derivatives of a photo has the highest quality.
+    Returns the checksums of those, so lower quality image downloads will be omitted.
     """
-    start_index = url.rindex('/') + 1
-    end_index = url.index('?')
-    return url[start_index:end_index]
+    best_derivatives = (max(photo['derivatives'].values(), key=_derivative_size)
+                        for photo in photos if photo.get('derivatives'))
+    # Derivatives without dimensions are never considered the best one
+    return [derivative.get('checksum') for derivative in best_derivatives if _derivative_size(derivative) > 0]
 
-# Original iclouder.py content
-def filter_best_assets(photos: List[dict], asset_urls: dict):
+def filter_best_assets(best_checksums: List[str], asset_urls: dict):
     """
-    Makes sure to check which of the derivatives of a photo has the highest quality.
-    Lower quality image downloads will be omitted.
-    """
-    best_checksums = []
-    for photo in photos:
-        maxdim = 0
-        best_derivative = None
-        for _, derivative in photo.get('derivatives', {}).items():
-            dim = int(derivative.get('width', '0')) * int(derivative.get('height', '0'))
-            if dim > maxdim:
-                maxdim = dim
-                best_derivative = derivative
-        if best_derivative:
-            best_checksums.append(best_derivative.get('checksum'))
-
-    result = {}
-    for checksum in best_checksums:
-        if checksum in asset_urls:
-            result[checksum] = asset_urls[checksum]
-    return result
-
-def get_stream(host: str, token: str, retries: int = 3):
+    Keep only the asset URLs of the highest quality derivatives.
+    """
+    return {checksum: asset_urls[checksum] for checksum in best_checksums if checksum in asset_urls}
+
+def dedupe_assets(assets: dict) -> dict:
+    """
+    Drop assets that point to the same file on the CDN as an earlier asset,
+    ignoring the signing parameters in the query string.
+    """
+    seen = {}
+    for checksum, item in assets.items():
+        key = (item['url_location'], item['url_path'].split('?', 1)[0])
+        seen.setdefault(key, (checksum, item))
+    return dict(seen.values())
+
+def get_stream(host: str, token: str, cache_file: pathlib.Path = None):
     """
     Download web stream of available photos.
+    When a cache file is given, the stream tag of the previous run is sent along
+    and the cached photo list is reused if the album did not change.
     """
-    url = f"https://{host}/{token}/sharedstreams/webstream"
-    attempt = 0
-    while attempt < retries:
-        try:
-            response = requests.post(url, json.dumps({'streamCtag': 'null'}), allow_redirects=True)
-            if response.status_code == 330:
-                redirect_data = json.loads(response.content)
-                new_host = redirect_data.get("X-Apple-MMe-Host")
-                return get_stream(new_host, token)
-            elif response.status_code == 200:
-                data = json.loads(response.content)
-                photos = data.get('photos')
-                asset_urls = get_asset_urls(host, token, [photo['photoGuid'] for photo in photos])
-                return filter_best_assets(photos, asset_urls.get('items', []))
+    cache = load_stream_cache(cache_file) if cache_file else {}
+    stream_ctag = cache.get('streamCtag')
+    redirects = 0
+    while True:
+        url = f"https://{host}/{token}/sharedstreams/webstream"
+        response = _post_json(url, {'streamCtag': stream_ctag or 'null'})
+        if response.status_code == 330:
+            # The album lives on another host, follow it and try again
+            redirects += 1
+            if redirects > _MAX_HOST_REDIRECTS:
+                raise ValueError("Too many host redirects")
+            redirect_data = _loads(response.content)
+            host = redirect_data.get("X-Apple-MMe-Host")
+            continue
+        if response.status_code != 200:
+            if stream_ctag:
+                # The server may reject an outdated tag, forget it and request the full listing
+                logger.debug(f"Status code: {response.status_code} for stream tag {stream_ctag}, dropping it.")
+                cache_file.unlink(missing_ok=True)
+                stream_ctag = None
+                continue
+            raise ValueError("Received an unexpected response from the server.")
+
+        data = _loads(response.content)
+        photos = data.get('photos')
+        if stream_ctag:
+            if not photos and data.get('streamCtag') == stream_ctag:
+                logger.debug("Album unchanged since the last run, using cached photo list.")
+                photos = cache.get('photos', [])
             else:
-                raise ValueError("Received an unexpected response from the server.")
-        except Exception as e:
-            attempt += 1
-            if attempt == retries:
-                raise e
+                # The album changed. The answer to a tag might only list the changes,
+                # so request the full listing instead of trusting it.
+                stream_ctag = None
+                continue
+        elif cache_file:
+            save_stream_cache(cache_file, data.get('streamCtag'), photos)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            asset_urls_future = executor.submit(get_all_asset_urls, host, token, [photo['photoGuid'] for photo in photos])
+            # Pick the best derivatives while the asset URLs are being fetched
+            best_checksums = get_best_checksums(photos)
+            return filter_best_assets(best_checksums, asset_urls_future.result())
+
+def load_stream_cache(cache_file: pathlib.Path) -> dict:
+    """
+    Load the stream tag and photo list saved by a previous run.
+    """
+    try:
+        with open(cache_file, 'rb') as f:
+            return _loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+def save_stream_cache(cache_file: pathlib.Path, stream_ctag: str, photos: List[dict]):
+    """
+    Save the stream tag and photo list so the next run can skip unchanged albums.
+    """
+    if not stream_ctag:
+        return
+    with open(cache_file, 'wb') as f:
+        f.write(_dumps({'streamCtag': stream_ctag, 'photos': photos}))
 
 def get_asset_urls(host: str, token: str, photoGuids: List[str]):
     """
     Get precise asset URLs based on a list of photo GUIDs.
     """
     url = f"https://{host}/{token}/sharedstreams/webasseturls"
-    response = requests.post(url, json.dumps({'photoGuids': photoGuids}), allow_redirects=True)
+    response = _post_json(url, {'photoGuids': photoGuids})
     if response.status_code == 200:
-        return json.loads(response.content)
+        return _loads(response.content)
     else:
         raise ValueError("Received an unexpected response from the server.")
 
-def download_file(url: str, directory: str, filename: str = None):
+def load_assets_cache(cache_file: pathlib.Path, ttl: int) -> Optional[dict]:
+    """
+    Load the assets saved by a previous run if they are less than ttl seconds old.
+    The asset URLs are signed and expire, so they are only reused for a short while.
+    """
+    try:
+        if time.time() - cache_file.stat().st_mtime > ttl:
+            return None
+        with open(cache_file, 'rb') as f:
+            return _loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+def save_assets_cache(cache_file: pathlib.Path, assets: dict):
+    """
+    Save the assets so that runs within the cache TTL can skip fetching the stream.
+    """
+    with open(cache_file, 'wb') as f:
+        f.write(_dumps(assets))
+
+def get_all_asset_urls(host: str, token: str, photoGuids: List[str], chunk_size: int = 100):
+    """
+    Get the asset URLs for all photo GUIDs, requesting them in concurrent chunks.
+    """
+    chunks = [photoGuids[i:i + chunk_size] for i in range(0, len(photoGuids), chunk_size)]
+    asset_urls = {}
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for result in executor.map(lambda chunk: get_asset_urls(host, token, chunk), chunks):
+            asset_urls.update(result.get('items', {}))
+    return asset_urls
+
+def download_file(url: str, directory: pathlib.Path, filename: str = None):
     """
     Download a single photo from the given URL to the specified directory.
+    Photos saved under their source filename are skipped if they already exist.
     """
-    response = requests.get(url, allow_redirects=True)
-    if response.status_code != 200:
-        logger.error("Failed to download a photo.")
-        logger.debug(f"Status code: {response.status_code} (for URL: {url})")
-    else:
-        if filename:
-            output_file = os.path.join(directory, filename)
-        else:
-            end_index = url.index('?')
-            start_index = url.rindex('/', 0, end_index)
-            file_name = url[(start_index + 1):end_index]
-            output_file = os.path.join(directory, file_name)
-        open(output_file, 'wb').write(response.content)
+    output_file = pathlib.Path(directory) / (filename or get_source_filename(url))
+    if not filename:
+        if output_file.exists() and output_file.stat().st_size > 0:
+            logger.debug(f"Skipping existing file: {output_file}")
+            return output_file
+
+    # Remove temporary files left behind by an interrupted earlier download
+    for stale_file in output_file.parent.glob(glob.escape(output_file.name) + '.*.part'):
+        stale_file.unlink(missing_ok=True)
+
+    with _SESSION.get(url, stream=True, timeout=_TIMEOUT, allow_redirects=True) as response:
+        if response.status_code != 200:
+            logger.debug(f"Status code: {response.status_code} (for URL: {url})")
+            raise ValueError("Failed to download a photo.")
+        size = int(response.headers.get('Content-Length') or 0)
+        ranged = (size >= _RANGED_DOWNLOAD_THRESHOLD
+                  and response.headers.get('Accept-Ranges') == 'bytes'
+                  and 'Content-Encoding' not in response.headers)
+        # Unique temporary file, so concurrent downloads never share one. It is
+        # created with open(..., 'xb') so the umask applies as for any other file.
+        part_file = output_file.with_name(f"{output_file.name}.{secrets.token_hex(4)}.part")
+        try:
+            if ranged:
+                logger.debug(f"Downloading {size} bytes in {_RANGED_DOWNLOAD_PARTS} parts (for URL: {url})")
+                response.close()
+                _download_ranges(response.url, part_file, size)
+            else:
+                # Stream the body to disk in fixed-size chunks instead of holding
+                # the whole photo in memory.
+                response.raw.decode_content = True
+                with open(part_file, 'xb') as f:
+                    shutil.copyfileobj(response.raw, f, length=1 << 16)
+            # Only move the file in place once it is complete
+            os.replace(part_file, output_file)
+        except BaseException:
+            if part_file.exists():
+                part_file.unlink()
+            raise
     return output_file
 
+def _download_range(url: str, output_file: pathlib.Path, start: int, end: int):
+    """
+    Download the given (inclusive) byte range of a file into the same range of output_file.
+    """
+    with _SESSION.get(url, headers={'Range': f"bytes={start}-{end}"}, stream=True, timeout=_TIMEOUT) as response:
+        if response.status_code != 206:
+            logger.debug(f"Status code: {response.status_code} (for range {start}-{end} of URL: {url})")
+            raise ValueError("Failed to download a photo.")
+        # Only write at start if the server actually sent the requested range
+        content_range = response.headers.get('Content-Range', '')
+        if not content_range.startswith(f"bytes {start}-{end}/"):
+            logger.debug(f"Content-Range: {content_range!r} (for range {start}-{end} of URL: {url})")
+            raise ValueError("Failed to download a photo.")
+        with open(output_file, 'r+b') as f:
+            f.seek(start)
+            shutil.copyfileobj(response.raw, f, length=1 << 16)
+
+def _download_ranges(url: str, output_file: pathlib.Path, size: int):
+    """
+    Download a large file using parallel range requests, each writing at its own offset.
+    """
+    with open(output_file, 'xb') as f:
+        f.truncate(size)
+    step = -(-size // _RANGED_DOWNLOAD_PARTS)
+    with ThreadPoolExecutor(max_workers=_RANGED_DOWNLOAD_PARTS) as executor:
+        futures = [executor.submit(_download_range, url, output_file, start, min(start + step, size) - 1)
+                   for start in range(0, size, step)]
+        for future in futures:
+            future.result()
+
+def get_output_filenames(filename: str, count: int, single: bool = False) -> List[str]:
+    """
+    Filenames to save the downloaded photos as.
+    Unless a single photo is downloaded, a running number is added (photo.jpg -> photo_2.jpg).
+    """
+    if single or not filename:
+        return [filename] * count
+    base, ext = os.path.splitext(filename)
+    return [f"{base}_{idx}{ext}" for idx in range(1, count + 1)]
+
 def select_random_photos(data, ignore_list, count):
     """
     Select a specified number of random photos that are not in the ignore list.
     """
-    available_photos = [guid for guid in data.keys() if guid not in ignore_list]
+    ignore_set = set(ignore_list)
+    available_photos = [guid for guid in data if guid not in ignore_set]
     logger.debug(f"Available photos count: {len(available_photos)}")
     if len(available_photos) < count:
         raise ValueError("Not enough new photos available to download.")
@@ -163,83 +349,120 @@ if __name__ == "__main__":
     parser.add_argument("--filename", help="Filename to save the single downloaded photo as.", default='random_photo.jpg')
     parser.add_argument("--ignore", help="Number of previously downloaded photos to ignore and log.", type=int)
     parser.add_argument("--log_downloads", help="Number of downloads to log GUIDs for.", type=int)
+    parser.add_argument("--cache_ttl", help="Seconds to reuse the album data fetched by a previous run "
+                                            "(0 disables all caching of album data).",
+                        type=int, default=300)
+    parser.add_argument("--jobs", "--concurrency", help="Number of photos to download in parallel.", type=int, default=16)
     arguments = parser.parse_args()
 
     logger = logging.getLogger("iclouder")
     logging.basicConfig(format='%(levelname)s: %(message)s',
                         level=logging.DEBUG if arguments.debug else logging.WARNING)
 
+    # Every download worker should get a pooled connection, otherwise the
+    # surplus connections are closed again after each request.
+    # Large assets are fetched with several range requests per worker.
+    _SESSION.mount("https://", _http_adapter(max(arguments.jobs, 8) * _RANGED_DOWNLOAD_PARTS))
+
     logger.debug("Loading: " + arguments.token)
 
     partition = get_partition(arguments.token)
     logger.debug("Partition: {}".format(partition))
 
-    host = f"p{partition}-sharedstreams.icloud.com"
+    directory = pathlib.Path(arguments.destination)
     try:
-        data = get_stream(host, arguments.token)
-        logger.debug(f"Fetched data: {data}")
-    except ValueError as e:
-        logger.error("Could not retrieve item stream! (Use the debug flag for more info.)")
-        if arguments.debug:
-            logger.exception(e)
+        directory.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        logger.error("Destination directory does not exist!")
         sys.exit()
 
-    directory = ""
-    if not os.path.exists(arguments.destination):
-        os.makedirs(arguments.destination)
-    if os.path.isdir(arguments.destination):
-        directory = arguments.destination
-        if not directory.endswith('/'):
-            directory += '/'
-    elif arguments.destination != '.':
-        logging.error("Destination directory does not exist!")
-        sys.exit()
+    # Cache files are per album so that several albums can share a destination
+    token_hash = hashlib.sha1(arguments.token.encode()).hexdigest()[:12]
+    assets_cache = directory / f'.assets_cache_{token_hash}.json'
+
+    data = load_assets_cache(assets_cache, arguments.cache_ttl) if arguments.cache_ttl > 0 else None
+    if data is not None:
+        logger.debug(f"Using cached data: {data}")
+    else:
+        host = f"p{partition}-sharedstreams.icloud.com"
+        try:
+            stream_cache = directory / f'.stream_cache_{token_hash}.json' if arguments.cache_ttl > 0 else None
+            data = dedupe_assets(get_stream(host, arguments.token, stream_cache))
+            logger.debug(f"Fetched data: {data}")
+        except (ValueError, requests.RequestException) as e:
+            logger.error("Could not retrieve item stream! (Use the debug flag for more info.)")
+            if arguments.debug:
+                logger.exception(e)
+            sys.exit()
+        if data and arguments.cache_ttl > 0:
+            save_assets_cache(assets_cache, data)
 
     # Log file for download history and ignore list
-    log_file = os.path.join(directory, 'download_log.txt')
-    log_entries = []
+    log_file = directory / 'download_log.txt'
+    # Bounded so the oldest entries drop off automatically when new ones are appended
+    log_entries = collections.deque(maxlen=arguments.ignore or arguments.log_downloads)
 
     # Load log entries from file if it exists
-    if os.path.exists(log_file):
+    if log_file.exists():
         with open(log_file, 'r') as f:
-            log_entries = f.read().splitlines()
+            log_entries.extend(line.rstrip('\n') for line in f)
+    initial_log_entries = tuple(log_entries)
 
     # Extract the ignore list from the log entries if --ignore is enabled
-    ignore_list = []
+    ignore_list = set()
     if arguments.ignore:
-        ignore_list = [entry.split(':')[0] for entry in log_entries[-arguments.ignore:]]
+        ignore_list = {entry.split(':', 1)[0] for entry in log_entries}
 
     logger.debug(f"Ignore list loaded: {ignore_list}")
 
-    if data:
-        try:
-            photo_guids = select_random_photos(data, ignore_list, arguments.count)
-            for idx, photo_guid in enumerate(photo_guids, start=1):
-                item = data[photo_guid]
-                url = get_download_url(item)
-                source_filename = get_source_filename(url)
-                
-                if arguments.single:
-                    download_file(url, directory, arguments.filename)
-                else:
-                    if arguments.filename:
-                        filename = f"{os.path.splitext(arguments.filename)[0]}_{idx}{os.path.splitext(arguments.filename)[1]}"
-                    else:
-                        filename = None
-                    download_file(url, directory, filename)
-                    
-                log_entries.append(f"{photo_guid}:{source_filename}")
-                if arguments.ignore and len(log_entries) > arguments.ignore:
-                    log_entries.pop(0)
-                elif arguments.log_downloads and len(log_entries) > arguments.log_downloads:
-                    log_entries.pop(0)
-        except ValueError as e:
-            logger.error(e)
-    else:
-        logger.error("No photos available to download.")
+    try:
+        if data:
+            try:
+                # A single photo is saved under one fixed name, so only download one
+                count = 1 if arguments.single else arguments.count
+                photo_guids = select_random_photos(data, ignore_list, count)
+                with ThreadPoolExecutor(max_workers=max(1, min(arguments.jobs, len(photo_guids)))) as executor:
+                    try:
+                        futures = {}
+                        output_names = set()
+                        filenames = get_output_filenames(arguments.filename, len(photo_guids), arguments.single)
+                        for photo_guid, filename in zip(photo_guids, filenames):
+                            url = get_download_url(data[photo_guid])
+                            source_filename = get_source_filename(url)
+                            # Parallel downloads must never write to the same file
+                            output_name = filename or source_filename
+                            if output_name in output_names:
+                                logger.warning(f"Skipping photo with duplicate filename: {output_name}")
+                                continue
+                            output_names.add(output_name)
+                            future = executor.submit(download_file, url, directory, filename)
+                            futures[future] = f"{photo_guid}:{source_filename}"
 
-    logger.debug(f"Log entries to save: {log_entries}")
+                        for future in as_completed(futures):
+                            entry = futures.pop(future)
+                            try:
+                                future.result()
+                            except Exception as e:
+                                logger.error(e)
+                                continue
+
+                            log_entries.append(entry)
+                    except BaseException:
+                        # On e.g. Ctrl-C, drop the queued downloads instead of
+                        # waiting for the whole batch to finish, but still log
+                        # the ones that were already running.
+                        executor.shutdown(wait=True, cancel_futures=True)
+                        log_entries.extend(entry for future, entry in futures.items()
+                                           if not future.cancelled() and future.exception() is None)
+                        raise
+            except ValueError as e:
+                logger.error(e)
+        else:
+            logger.error("No photos available to download.")
+    finally:
+        logger.debug(f"Log entries to save: {log_entries}")
 
-    # Save log entries to file
-    with open(log_file, 'w') as f:
-        f.write('\n'.join(log_entries))
+        # Save log entries to file unless nothing changed, also when the batch was interrupted
+        if tuple(log_entries) != initial_log_entries:
+            with open(log_file, 'w', buffering=1 << 16) as f:
+                f.writelines(entry + '\n' for entry in log_entries)